@@ -1,14 +1,35 @@
 import asyncio
+import logging
 import os
+import re
+import sys
+import orjson
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.websockets import WebSocketState
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from session_manager import SessionManager
-from models import VibrateMessage, SessionMessage, StatusMessage, WebSocketMessage
 
 load_dotenv()
 
+# uvicorn's --log-level only configures uvicorn's own loggers, so the app's
+# "buzz" logger gets its own level (LOG_LEVEL, default INFO) and handler
+logger = logging.getLogger("buzz")
+_log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(levelname)s:     %(name)s - %(message)s"))
+logger.addHandler(_log_handler)
+logger.propagate = False
+if isinstance(logging.getLevelName(_log_level), int):
+    logger.setLevel(_log_level)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning("Unknown LOG_LEVEL %r, using INFO", _log_level)
+
+_VALID_PATTERNS: frozenset[int] = frozenset((1, 2, 3, 4, 5))
+_SESSION_RE = re.compile(r"[0-9]{6}")
+
 # Initialize session manager
 session_manager = SessionManager()
 
@@ -57,76 +78,71 @@ async def websocket_endpoint(websocket: WebSocket, session_code: str):
         if session_code == "new":
             # Create new session
             connection_session_code = await session_manager.create_session(websocket)
-            await websocket.send_json({
+            await session_manager.send_message(websocket, {
                 "type": "session_created",
                 "session_code": connection_session_code,
                 "user_count": 1
             })
         else:
             # Validate session code format
-            if not session_code.isdigit() or len(session_code) != 6:
-                await websocket.send_json({
+            if not _SESSION_RE.fullmatch(session_code):
+                await session_manager.send_message(websocket, {
                     "type": "error",
                     "message": "Invalid session code format"
                 })
                 await websocket.close()
                 return
 
-            # Try to join existing session
+            # Try to join existing session; on success join_session queues
+            # session_joined ahead of the partner_connected notifications
             success, error_message = await session_manager.join_session(session_code, websocket)
             if not success:
-                await websocket.send_json({
+                await session_manager.send_message(websocket, {
                     "type": "error",
                     "message": error_message or "Failed to join session"
                 })
                 await websocket.close()
                 return
 
-            connection_session_code = session_code
-            # Get current user count from session
-            session = session_manager.sessions.get(connection_session_code, [])
-            current_user_count = len(session)
-            
-            await websocket.send_json({
-                "type": "session_joined",
-                "session_code": connection_session_code,
-                "user_count": current_user_count
-            })
-
-        # Handle incoming messages
-        while True:
+        # Handle incoming messages until either side closes the socket; the
+        # server closes slow clients itself (SessionManager._evict)
+        while websocket.application_state is WebSocketState.CONNECTED:
             try:
-                data = await websocket.receive_json()
+                raw = await websocket.receive_text()
+                if websocket.application_state is not WebSocketState.CONNECTED:
+                    # Closed by the server while this frame was in flight
+                    break
+                data = orjson.loads(raw)
                 
                 # Validate message structure
-                try:
-                    message = WebSocketMessage(**data)
-                except Exception as e:
-                    await websocket.send_json({
+                msg_type = data.get("type") if isinstance(data, dict) else None
+                if not isinstance(msg_type, str):
+                    await session_manager.send_message(websocket, {
                         "type": "error",
-                        "message": f"Invalid message format: {str(e)}"
+                        "message": "Invalid message format: 'type' must be a string"
                     })
                     continue
 
                 # Handle different message types
-                if message.type == "create_session":
+                if msg_type == "create_session":
                     # Already handled in connection phase
                     continue
                 
-                elif message.type == "join_session":
+                elif msg_type == "join_session":
                     # Already handled in connection phase
                     continue
                 
-                elif message.type == "vibrate":
-                    if message.pattern is None:
-                        await websocket.send_json({
+                elif msg_type == "vibrate":
+                    pattern = data.get("pattern")
+                    if pattern is None:
+                        await session_manager.send_message(websocket, {
                             "type": "error",
                             "message": "Vibration pattern is required"
                         })
                         continue
                     
-                    if message.pattern not in [1, 2, 3, 4, 5]:
-                        await websocket.send_json({
+                    if type(pattern) is not int or pattern not in _VALID_PATTERNS:
+                        await session_manager.send_message(websocket, {
                             "type": "error",
                             "message": "Vibration pattern must be 1, 2, 3, 4, or 5"
                         })
@@ -134,31 +150,40 @@ async def websocket_endpoint(websocket: WebSocket, session_code: str):
 
                     # Get session code for this connection
                     session_code_for_vibrate = session_manager.get_session_code(websocket)
-                    print(f"DEBUG: Received vibration message - pattern: {message.pattern}, session_code: {session_code_for_vibrate}")
                     if session_code_for_vibrate:
                         await session_manager.broadcast_vibration(
                             session_code_for_vibrate,
-                            message.pattern,
+                            pattern,
                             websocket
                         )
                     else:
-                        print(f"ERROR: No session code found for this WebSocket connection")
-                        await websocket.send_json({
+                        logger.error("No session code found for this WebSocket connection")
+                        await session_manager.send_message(websocket, {
                             "type": "error",
                             "message": "Not connected to a session"
                         })
                 else:
-                    await websocket.send_json({
+                    await session_manager.send_message(websocket, {
                         "type": "error",
-                        "message": f"Unknown message type: {message.type}"
+                        "message": f"Unknown message type: {msg_type}"
                     })
 
             except WebSocketDisconnect:
                 break
+            except orjson.JSONDecodeError as e:
+                # Client sent something that is not JSON; no traceback needed
+                logger.warning("Malformed message from client: %s", e)
+                try:
+                    await session_manager.send_message(websocket, {
+                        "type": "error",
+                        "message": "Invalid message format: expected JSON"
+                    })
+                except:
+                    break
             except Exception as e:
-                print(f"Error handling message: {e}")
+                logger.exception("Error handling message")
                 try:
-                    await websocket.send_json({
+                    await session_manager.send_message(websocket, {
                         "type": "error",
                         "message": f"Error processing message: {str(e)}"
                     })
@@ -167,8 +192,8 @@ async def websocket_endpoint(websocket: WebSocket, session_code: str):
 
     except WebSocketDisconnect:
         pass
-    except Exception as e:
-        print(f"WebSocket error: {e}")
+    except Exception:
+        logger.exception("WebSocket error")
     finally:
         # Clean up connection
         await session_manager.remove_connection(websocket)
@@ -177,9 +202,17 @@ async def websocket_endpoint(websocket: WebSocket, session_code: str):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        # uvloop is not available on Windows
+        loop="uvloop" if sys.platform != "win32" else "asyncio",
+        http="httptools",
+        ws="websockets"
+    )
 else:
     # For Railway and other platforms that set PORT automatically
-    # The app will be run via: uvicorn main:app --host 0.0.0.0 --port $PORT
+    # The app will be run via: uvicorn main:app --host 0.0.0.0 --port $PORT --loop uvloop
     pass
 
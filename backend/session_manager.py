@@ -1,68 +1,152 @@
 import asyncio
+import logging
 import random
-import time
-from typing import Dict, List, Optional, Tuple
+from array import array
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
 from fastapi import WebSocket
-import json
+from fastapi.websockets import WebSocketState
+import orjson
+
+logger = logging.getLogger("buzz")
+
+
+# Outbound messages a client may have pending before it is considered too
+# slow to keep up and is disconnected
+SEND_QUEUE_SIZE = 16
+
+# Close code sent to clients dropped for falling behind ("Try Again Later")
+SLOW_CLIENT_CLOSE_CODE = 1013
+
+# Repeats of the same pattern from the same sender closer together than this
+# (in seconds) are dropped; phone haptic engines cannot tell them apart anyway
+VIBRATE_DEBOUNCE = 0.05
+
+# An ASGI "websocket.send" event, queued for a client's writer task
+Frame = Dict[str, Any]
+
+# Ready-made ASGI send events for each vibration pattern, shared by every
+# broadcast so the hot path allocates nothing per message
+_VIBRATE_FRAMES: Dict[int, Frame] = {
+    pattern: {
+        "type": "websocket.send",
+        "text": orjson.dumps({"type": "vibrate", "pattern": pattern}).decode()
+    }
+    for pattern in range(1, 6)
+}
+
+
+@dataclass(slots=True)
+class SessionMeta:
+    """Timestamps (event loop clock) for a session"""
+    created_at: float
+    last_activity: float
+
+
+@dataclass(slots=True, eq=False)
+class Client:
+    """A session member with its own outbound queue, drained by a writer task"""
+    ws: WebSocket
+    out_queue: asyncio.Queue[Frame] = field(default_factory=lambda: asyncio.Queue(maxsize=SEND_QUEUE_SIZE))
+    task: Optional[asyncio.Task[None]] = None
+    # Debounce state for vibrations sent by this client (event loop clock)
+    last_vibrate_ts: float = float("-inf")
+    last_pattern: Optional[int] = None
+
+
+async def _relay(client: Client) -> None:
+    """Writer task: send queued frames to the client's socket in order"""
+    ws = client.ws
+    try:
+        while True:
+            frame = await client.out_queue.get()
+            if ws.client_state is not WebSocketState.CONNECTED:
+                return
+            await ws.send(frame)
+    except Exception as e:
+        # The receive loop for this socket will see the disconnect and
+        # remove it from its session
+        logger.debug("Writer stopped: %s: %s", type(e).__name__, e)
+
+
+async def _close(connection: WebSocket, code: int) -> None:
+    """Close a connection, ignoring errors if it is already gone"""
+    try:
+        await connection.close(code=code)
+    except Exception:
+        pass
 
 
 class SessionManager:
-    def __init__(self):
-        self.sessions: Dict[str, List[WebSocket]] = {}
-        self.session_metadata: Dict[str, Dict] = {}
-        self.connection_to_session: Dict[WebSocket, str] = {}
-        self._cleanup_task: Optional[asyncio.Task] = None
+    def __init__(self) -> None:
+        self.sessions: Dict[str, Set[Client]] = {}
+        self.session_metadata: Dict[str, SessionMeta] = {}
+        # Every 6-digit code in random order; popping from the end hands out
+        # unique codes without retrying on collisions
+        self._code_pool = array("I", range(100000, 1000000))
+        random.shuffle(self._code_pool)
+        # Codes freed by removed sessions, reused only once the pool runs dry
+        self._recycled_codes: Deque[int] = deque()
+        # Vibrations staged during the current event loop tick, per session,
+        # as (pattern, sender) pairs; sent together by _flush
+        self._pending: Dict[str, List[Tuple[int, Optional[Client]]]] = {}
+        self._flush_scheduled = False
+        # Close handshakes of evicted clients, kept referenced until done
+        self._closing: Set[asyncio.Task[None]] = set()
+        self._cleanup_task: Optional[asyncio.Task[None]] = None
         self._start_cleanup_task()
 
-    def _start_cleanup_task(self):
+    def _start_cleanup_task(self) -> None:
         """Start background task to clean up inactive sessions"""
         if self._cleanup_task is None or self._cleanup_task.done():
             self._cleanup_task = asyncio.create_task(self._cleanup_inactive_sessions())
 
-    async def _cleanup_inactive_sessions(self):
+    async def _cleanup_inactive_sessions(self) -> None:
         """Background task that runs every 5 minutes to clean up inactive sessions"""
         while True:
             try:
                 await asyncio.sleep(300)  # 5 minutes
-                current_time = time.time()
+                current_time = asyncio.get_running_loop().time()
                 sessions_to_remove = []
 
                 for session_code, metadata in self.session_metadata.items():
-                    last_activity = metadata.get("last_activity", 0)
                     # Remove sessions inactive for 1 hour
-                    if current_time - last_activity > 3600:
+                    if current_time - metadata.last_activity > 3600:
                         sessions_to_remove.append(session_code)
 
                 for session_code in sessions_to_remove:
-                    await self._remove_session(session_code)
+                    self._remove_session(session_code)
             except asyncio.CancelledError:
                 break
-            except Exception as e:
-                print(f"Error in cleanup task: {e}")
+            except Exception:
+                logger.exception("Error in cleanup task")
 
     def generate_session_code(self) -> str:
         """Generate a unique 6-digit session code"""
-        while True:
-            code = f"{random.randint(100000, 999999)}"
-            if code not in self.sessions:
-                return code
+        if self._code_pool:
+            return str(self._code_pool.pop())
+        if self._recycled_codes:
+            return str(self._recycled_codes.popleft())
+        raise RuntimeError("No session codes available")
 
     async def create_session(self, connection: WebSocket) -> str:
         """Create a new session and return the session code"""
         session_code = self.generate_session_code()
-        self.sessions[session_code] = [connection]
-        self.connection_to_session[connection] = session_code
-        self.session_metadata[session_code] = {
-            "created_at": time.time(),
-            "last_activity": time.time()
-        }
-        print(f"DEBUG: Created new session {session_code} with 1 connection")
+        now = asyncio.get_running_loop().time()
+        self.sessions[session_code] = {self._attach(session_code, connection)}
+        self.session_metadata[session_code] = SessionMeta(
+            created_at=now,
+            last_activity=now
+        )
+        logger.debug("Created new session %s with 1 connection", session_code)
         return session_code
 
     async def join_session(self, session_code: str, connection: WebSocket) -> Tuple[bool, Optional[str]]:
         """
         Join an existing session. Returns (success, error_message)
-        Maximum 5 users per session.
+        Maximum 5 users per session. On success the joiner is sent
+        session_joined, followed by partner_connected to every member.
         """
         if session_code not in self.sessions:
             return False, "Session not found"
@@ -72,136 +156,225 @@ class SessionManager:
         if len(session) >= 5:
             return False, "Session is full (maximum 5 users)"
 
-        if connection in session:
+        if self.get_session_code(connection) == session_code:
             return False, "Already in this session"
 
-        session.append(connection)
-        self.connection_to_session[connection] = session_code
-        self.session_metadata[session_code]["last_activity"] = time.time()
-
-        print(f"DEBUG: User joined session {session_code}. Total connections: {len(session)}")
-
-        # Notify all users in the session about the new connection
-        # Send partner_connected to all existing users (excluding the new one)
-        for existing_connection in session:
-            if existing_connection != connection:
-                try:
-                    await existing_connection.send_json({
-                        "type": "partner_connected",
-                        "session_code": session_code,
-                        "user_count": len(session)
-                    })
-                    print(f"DEBUG: Sent partner_connected to existing user (total: {len(session)})")
-                except Exception as e:
-                    print(f"ERROR: Error notifying existing user: {e}")
-        
-        # Notify the newly joined user about existing connections
+        client = self._attach(session_code, connection)
+        session.add(client)
+        self.session_metadata[session_code].last_activity = asyncio.get_running_loop().time()
+
+        logger.debug("User joined session %s. Total connections: %d", session_code, len(session))
+
+        # Queued before partner_connected so the joiner sees it first
+        self._fan_out(session_code, (client,), {
+            "type": "session_joined",
+            "session_code": session_code,
+            "user_count": len(session)
+        })
+
+        # Notify every user in the session, including the newly joined one,
+        # about the new connection
         if len(session) > 1:
-            try:
-                await connection.send_json({
-                    "type": "partner_connected",
-                    "session_code": session_code,
-                    "user_count": len(session)
-                })
-                print(f"DEBUG: Sent partner_connected to new user (total: {len(session)})")
-            except Exception as e:
-                print(f"ERROR: Error notifying new user: {e}")
-        
-        print(f"DEBUG: Session {session_code} now has {len(session)} user(s)")
+            self._fan_out(session_code, session, {
+                "type": "partner_connected",
+                "session_code": session_code,
+                "user_count": len(session)
+            })
 
         return True, None
 
-    async def broadcast_vibration(self, session_code: str, pattern: int, sender: WebSocket):
-        """Broadcast vibration pattern to partner (exclude sender)"""
+    async def broadcast_vibration(self, session_code: str, pattern: int, sender: WebSocket) -> None:
+        """
+        Broadcast vibration pattern to partner (exclude sender). Vibrations
+        arriving in the same event loop tick are coalesced and queued on each
+        partner's writer task by _flush, so a slow partner never blocks the
+        sender.
+        """
         if session_code not in self.sessions:
-            print(f"ERROR: Session {session_code} not found in sessions")
+            logger.error("Session %s not found in sessions", session_code)
             return
 
         session = self.sessions[session_code]
-        self.session_metadata[session_code]["last_activity"] = time.time()
-
-        print(f"DEBUG: Broadcasting vibration pattern {pattern} in session {session_code}")
-        print(f"DEBUG: Session has {len(session)} connection(s)")
-        print(f"DEBUG: Sender is in session: {sender in session}")
-
-        # Send to all connections in session except sender
-        sent_count = 0
-        for i, connection in enumerate(session):
-            print(f"DEBUG: Checking connection {i}: {id(connection)} (sender: {id(sender)})")
-            if connection != sender:
-                try:
-                    # Check if connection is still open by trying to send
-                    print(f"DEBUG: Attempting to send vibration to partner connection {i}")
-                    await connection.send_json({
-                        "type": "vibrate",
-                        "pattern": pattern
-                    })
-                    sent_count += 1
-                    print(f"DEBUG: ✓ Successfully sent vibration message to partner")
-                except Exception as e:
-                    print(f"ERROR: ✗ Failed to send vibration to partner: {type(e).__name__}: {e}")
-                    print(f"ERROR: Connection {i} may be closed or invalid - removing from session")
-                    # Remove dead connection from session
-                    try:
-                        session.remove(connection)
-                        if connection in self.connection_to_session:
-                            del self.connection_to_session[connection]
-                    except:
-                        pass
-            else:
-                print(f"DEBUG: Skipping sender connection {i}")
-        
-        if sent_count == 0:
-            print(f"WARNING: ⚠ No vibration messages were sent!")
-            print(f"WARNING: Session {session_code} has {len(session)} connection(s)")
-            if len(session) == 1:
-                print(f"WARNING: Only 1 connection in session - sender has no partner!")
-            elif len(session) == 2:
-                print(f"WARNING: Session has 2 connections but message wasn't sent - possible connection issue")
-
-    async def remove_connection(self, connection: WebSocket):
+        sender_client = getattr(sender.state, "client", None)
+        now = asyncio.get_running_loop().time()
+        if sender_client is not None:
+            if pattern == sender_client.last_pattern and now - sender_client.last_vibrate_ts < VIBRATE_DEBOUNCE:
+                return
+            sender_client.last_vibrate_ts = now
+            sender_client.last_pattern = pattern
+        self.session_metadata[session_code].last_activity = now
+
+        # Nobody to vibrate when the sender is alone in the session
+        if len(session) < 2:
+            return
+
+        staged = self._pending.get(session_code)
+        if staged is None:
+            self._pending[session_code] = [(pattern, sender_client)]
+        else:
+            staged.append((pattern, sender_client))
+
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self) -> None:
+        """Send the vibrations staged during the last event loop tick"""
+        self._flush_scheduled = False
+        pending, self._pending = self._pending, {}
+
+        for session_code, staged in pending.items():
+            session = self.sessions.get(session_code)
+            if not session:
+                continue
+
+            if len(staged) == 1:
+                pattern, sender = staged[0]
+                targets: Iterable[Client]
+                if len(session) == 2:
+                    # Common two-person case: the target is simply the peer
+                    first, second = session
+                    if first is sender:
+                        targets = (second,)
+                    elif second is sender:
+                        targets = (first,)
+                    else:
+                        targets = (first, second)
+                else:
+                    targets = [c for c in session if c is not sender]
+                self._enqueue(session_code, targets, _VIBRATE_FRAMES[pattern])
+                continue
+
+            # Several vibrations in one tick: still one cached vibrate frame
+            # per pattern, in arrival order, since installed clients only
+            # understand "vibrate"
+            for pattern, sender in staged:
+                targets = [c for c in session if c is not sender]
+                self._enqueue(session_code, targets, _VIBRATE_FRAMES[pattern])
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Flushed %d vibrations in session %s", len(staged), session_code)
+
+    def _attach(self, session_code: str, connection: WebSocket) -> Client:
+        """Wrap a connection in a Client and start its writer task"""
+        client = Client(connection)
+        client.task = asyncio.create_task(_relay(client))
+        connection.state.session_code = session_code
+        connection.state.client = client
+        return client
+
+    def _detach(self, client: Client) -> None:
+        """Stop a client's writer task and forget its session"""
+        if client.task:
+            client.task.cancel()
+        client.ws.state.session_code = None
+        client.ws.state.client = None
+
+    def _fan_out(self, session_code: str, targets: Iterable[Client], message: Dict[str, Any]) -> int:
+        """
+        Serialize message once into an ASGI send event and queue that same
+        event for all targets. Returns the number of dropped clients.
+        """
+        frame = {"type": "websocket.send", "text": orjson.dumps(message).decode()}
+        return self._enqueue(session_code, targets, frame)
+
+    def _enqueue(self, session_code: str, targets: Iterable[Client], frame: Frame) -> int:
+        """
+        Queue a send event for all targets. Clients whose queue is full are
+        disconnected. Returns the number of dropped clients.
+        """
+        overflowed = []
+        for client in targets:
+            # Skip sockets that already went away; their receive loop will
+            # remove them from the session
+            if client.ws.client_state is not WebSocketState.CONNECTED:
+                continue
+            try:
+                client.out_queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                overflowed.append(client)
+
+        for client in overflowed:
+            logger.warning(
+                "Send queue full in session %s - disconnecting slow client",
+                session_code
+            )
+            self._evict(session_code, client)
+        return len(overflowed)
+
+    def _evict(self, session_code: str, client: Client) -> None:
+        """
+        Drop a client that cannot keep up, close its socket and notify the
+        remaining members. The socket is detached right away, so it can
+        neither queue replies nor broadcast while the close completes.
+        """
+        session = self.sessions.get(session_code)
+        if session is None or client not in session:
+            return
+
+        session.discard(client)
+        self._detach(client)
+        close_task = asyncio.create_task(_close(client.ws, SLOW_CLIENT_CLOSE_CODE))
+        self._closing.add(close_task)
+        close_task.add_done_callback(self._closing.discard)
+
+        if len(session) > 0:
+            self._fan_out(session_code, session, {
+                "type": "partner_disconnected",
+                "session_code": session_code,
+                "user_count": len(session)
+            })
+        else:
+            self._remove_session(session_code)
+
+    async def remove_connection(self, connection: WebSocket) -> None:
         """Remove a connection from its session"""
-        if connection not in self.connection_to_session:
+        session_code = self.get_session_code(connection)
+        if session_code is None:
             return
 
-        session_code = self.connection_to_session[connection]
-        
+        client = connection.state.client
+        self._detach(client)
+
         if session_code in self.sessions:
             session = self.sessions[session_code]
-            if connection in session:
-                session.remove(connection)
+            session.discard(client)
 
             # Notify all remaining users in the session about the disconnection
             if len(session) > 0:
-                for remaining_connection in session:
-                    try:
-                        await remaining_connection.send_json({
-                            "type": "partner_disconnected",
-                            "session_code": session_code,
-                            "user_count": len(session)
-                        })
-                    except Exception as e:
-                        print(f"Error notifying user of disconnect: {e}")
+                self._fan_out(session_code, session, {
+                    "type": "partner_disconnected",
+                    "session_code": session_code,
+                    "user_count": len(session)
+                })
 
             # Remove session if empty
             if len(session) == 0:
-                await self._remove_session(session_code)
+                self._remove_session(session_code)
 
-        del self.connection_to_session[connection]
-
-    async def _remove_session(self, session_code: str):
+    def _remove_session(self, session_code: str) -> None:
         """Remove a session completely"""
         if session_code in self.sessions:
-            # Close all connections in the session
-            for connection in self.sessions[session_code]:
-                if connection in self.connection_to_session:
-                    del self.connection_to_session[connection]
+            for client in self.sessions[session_code]:
+                self._detach(client)
             del self.sessions[session_code]
+            self._recycled_codes.append(int(session_code))
         
         if session_code in self.session_metadata:
             del self.session_metadata[session_code]
 
+    async def send_message(self, connection: WebSocket, message: Dict[str, Any]) -> None:
+        """
+        Send a message to one connection. Once the connection is attached to a
+        session the message goes through its writer queue, which is then the
+        only thing writing to the socket, so messages keep their order.
+        """
+        client: Optional[Client] = getattr(connection.state, "client", None)
+        if client is None:
+            await connection.send_text(orjson.dumps(message).decode())
+            return
+        self._fan_out(self.get_session_code(connection) or "", (client,), message)
+
     def get_session_code(self, connection: WebSocket) -> Optional[str]:
         """Get the session code for a connection"""
-        return self.connection_to_session.get(connection)
-
+        return getattr(connection.state, "session_code", None)
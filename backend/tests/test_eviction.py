@@ -0,0 +1,135 @@
+"""
+Regression tests for slow-client eviction, driven through the ASGI app with
+in-memory sockets. Run from backend/ with: pytest tests
+"""
+
+import asyncio
+import importlib
+import json
+import logging
+import threading
+
+
+class FakeSocket:
+    """One ASGI WebSocket connection to the app, fed and observed in memory"""
+
+    def __init__(self, path: str, stall_sends: bool = False):
+        self.scope = {
+            "type": "websocket",
+            "asgi": {"version": "3.0"},
+            "scheme": "ws",
+            "server": ("testserver", 80),
+            "client": ("testclient", 50000),
+            "root_path": "",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": b"",
+            "headers": [],
+            "subprotocols": [],
+            "state": {},
+        }
+        self.inbound: asyncio.Queue = asyncio.Queue()
+        self.inbound.put_nowait({"type": "websocket.connect"})
+        self.stall_sends = stall_sends
+        self.sent = []
+        self.close_code = None
+        self.task = None
+
+    async def receive(self):
+        return await self.inbound.get()
+
+    async def send(self, message):
+        if message["type"] == "websocket.close":
+            self.close_code = message.get("code", 1000)
+        elif message["type"] == "websocket.send":
+            if self.stall_sends:
+                # A phone that stopped reading: the write never completes
+                await asyncio.Event().wait()
+            self.sent.append(json.loads(message["text"]))
+
+    def start(self, app):
+        self.task = asyncio.create_task(app(self.scope, self.receive, self.send))
+
+    def send_json(self, message):
+        self.inbound.put_nowait({"type": "websocket.receive", "text": json.dumps(message)})
+
+
+def _run_with_timeout(scenario, timeout: float = 10):
+    """
+    Run scenario on its own event loop in a thread, so a handler that spins
+    without yielding fails the test instead of hanging it.
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = asyncio.run(scenario())
+        except BaseException as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "event loop did not finish - handler is spinning"
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+async def _settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+class _RecordList(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_evicted_client_with_buffered_frame_ends_cleanly():
+    records = _RecordList()
+    logging.getLogger("buzz").addHandler(records)
+
+    async def scenario():
+        main = importlib.import_module("main")
+        session_manager_module = importlib.import_module("session_manager")
+        main.session_manager = session_manager_module.SessionManager()
+
+        slow = FakeSocket("/ws/new", stall_sends=True)
+        slow.start(main.app)
+        await _settle()
+        (session_code,) = main.session_manager.sessions
+
+        partner = FakeSocket(f"/ws/{session_code}")
+        partner.start(main.app)
+        await _settle()
+
+        # Alternate patterns so the sender debounce lets every one through
+        for i in range(40):
+            partner.send_json({"type": "vibrate", "pattern": 1 + i % 2})
+            await _settle()
+
+        assert slow.close_code == session_manager_module.SLOW_CLIENT_CLOSE_CODE
+
+        # A frame the slow client sent before it saw the close
+        slow.send_json({"type": "vibrate", "pattern": 3})
+        await asyncio.wait_for(slow.task, timeout=2)
+        await _settle()
+
+        partner.inbound.put_nowait({"type": "websocket.disconnect", "code": 1000})
+        await asyncio.wait_for(partner.task, timeout=2)
+        main.session_manager._cleanup_task.cancel()
+        return partner.sent
+
+    try:
+        partner_sent = _run_with_timeout(scenario)
+    finally:
+        logging.getLogger("buzz").removeHandler(records)
+
+    assert {"type": "partner_disconnected", "session_code": partner_sent[0]["session_code"], "user_count": 1} in partner_sent
+    # The evicted socket's loop ends quietly instead of erroring on the closed socket
+    assert not [r for r in records.records if r.levelno >= logging.ERROR]